@@ -5,8 +5,9 @@ filefinder
 
 Simplistic but cross-platform version of Everything https://www.voidtools.com/
 
-XXX Filtering is slow when it forces full db scan on Raspberry Pi, needs sqlite3
-    Full Text Search?
+XXX Filtering words of three or more characters uses an sqlite3 FTS5 trigram
+    index when available, but shorter words (or sqlite versions without FTS5
+    trigram) still force a full db scan which is slow on Raspberry Pi
 XXX Use trees and transitive closure?
     See https://charlesleifer.com/blog/querying-tree-structures-in-sqlite-using-python-and-the-transitive-closure-extension/
 XXX Use tree and recursive queries?
@@ -35,14 +36,41 @@ import collections
 import csv
 import datetime
 import errno
+import functools
 import logging
+import multiprocessing
 import os
 import sqlite3
 import stat
-import string
 import struct
 import sys
+import time
+from multiprocessing.pool import ThreadPool
 
+try:
+    import queue
+
+except ImportError:
+    # Python 2.7
+    import Queue as queue
+
+try:
+    unicode
+
+except NameError:
+    # Python 3 strings are already unicode
+    unicode = str
+
+try:
+    from os import scandir
+
+except ImportError:
+    try:
+        # Python 2.7 needs the backport, pip install scandir
+        from scandir import scandir
+
+    except ImportError:
+        scandir = None
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
@@ -122,46 +150,136 @@ def which(exepath):
     return None
 
 
-def launch_with_preferred_app(filepath):
+def get_preferred_app_launcher():
+    """
+    @return {function} function taking a filepath and launching it with the
+            preferred application for this platform
+    """
     # pyqt5 on lxde raspbian fails to invoke xdg-open for unknown reasons and
     # falls back to invoking the web browser instead, use xdg-open explicitly on
     # "xcb" platforms (X11) 
     # See https://github.com/qt/qtbase/blob/067b53864112c084587fa9a507eb4bde3d50a6e1/src/gui/platform/unix/qgenericunixservices.cpp#L129
     if (QApplication.platformName() != "xcb"):
-        url = QUrl.fromLocalFile(filepath)
-        QDesktopServices.openUrl(url)
+        return lambda filepath: QDesktopServices.openUrl(QUrl.fromLocalFile(filepath))
         
     else:
         # Note there's no splitCommand in this version of Qt5, build the
         # argument list manually
-        QProcess.startDetached("xdg-open", [filepath])
+        return lambda filepath: QProcess.startDetached("xdg-open", [filepath])
+
+
+preferred_app_launcher = None
+def launch_with_preferred_app(filepath):
+    global preferred_app_launcher
+    # The platform doesn't change at runtime so pick the launcher only once.
+    # Note this can't be done at import time since platformName needs a
+    # QApplication
+    if (preferred_app_launcher is None):
+        preferred_app_launcher = get_preferred_app_launcher()
+    
+    preferred_app_launcher(filepath)
+
 
+def cached(max_entries):
+    """
+    Decorator to cache the results of a single argument function, the cache is
+    cleared when it reaches max_entries.
+
+    Python 2.7 doesn't have functools.lru_cache
+    """
+    def decorator(fn):
+        cache = {}
+        # Keep the name and docstring of the decorated function
+        @functools.wraps(fn)
+        def cached_fn(arg):
+            value = cache.get(arg)
+            if (value is None):
+                if (len(cache) >= max_entries):
+                    cache.clear()
+                value = fn(arg)
+                cache[arg] = value
+            return value
+        
+        return cached_fn
+
+    return decorator
 
+
+size_units = ["B", "KB", "MB", "GB", "TB"]
+@cached(1024)
 def size_to_human_friendly_units(u):
     """
     @return {string} u as a human friendly power of 1024 unit (TB, GB, MB, KB,
             B)
     """
-    d = 1
-    for unit in ["B", "KB", "MB", "GB", "TB"]:
-        new_d = d * (2 ** 10)
-        if (u < new_d):
-            break
-        d = new_d
+    # Each unit is 10 bits, the number of bits gives the unit directly without
+    # looping over the units
+    i_unit = min(len(size_units) - 1, max(0, (u.bit_length() - 1) // 10))
         
-    return "%0.2f %s" % (u * 1.0/d, unit)
+    return "%0.2f %s" % (u * 1.0 / (1 << (10 * i_unit)), size_units[i_unit])
+
+@cached(8192)
+def mtime_to_string(mtime):
+    """
+    @return {string} mtime in milliseconds as local date and time truncated to
+            seconds
+    """
+    return str(datetime.datetime.fromtimestamp(mtime // 1000))
 
 database_filepath = os.path.join("_out", "files.db")
 ##database_filepath = os.path.join("_out", "test.db")
+# Number of threads listing new directories ahead of the worker, these are
+# latency bound (specially on network drives) so there can be more threads than
+# cores
+listing_threads = 16
+# Maximum number of directory listings waiting to be consumed by the worker
+max_prefetched_listings = 256
+# Minimum seconds between directory traversal messages sent to the UI, around
+# one frame
+traversing_message_interval = 0.016
+# Maximum number of rows of a non modified directory to skip by fetching them
+# before falling back to skipping by requerying
+max_skipped_rows = 32
+
+def connect_db():
+    """
+    Connect to database_filepath and apply the per-connection settings.
+
+    The database is already in WAL mode (persistent setting done at creation
+    time), these are per-connection settings:
+    - In WAL mode synchronous NORMAL only syncs at checkpoint time instead of
+      on every commit, this is still safe from corruption but may lose the
+      last commits on power loss, which will be redone on the next update
+      anyway
+    - Keep temporary tables (eg the filtered rowids) and sorting b-trees in
+      memory
+    - Use a 64MB page cache instead of the default 2MB, filter scans, page
+      fetches and the update traversal revisit the same pages
+    - Memory map the database file to avoid copying pages from the OS cache
+
+    Older sqlite versions ignore the settings they don't support
+
+    @return {sqlite3.Connection}
+    """
+    conn = sqlite3.connect(database_filepath)
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-65536;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+
+    return conn
 
 class TableModel(QAbstractTableModel):
     """
     TableModel with filtering, sorting and on-demand display
 
     The on-demand display is done by
-    - returning only loaded_row_count in rowCount()
-    - returning True in canFetchMore if loaded_row_count < len(data)
-    - updating loaded_row_count in fetchMoreRows
+    - returning the number of rows matching the filter in rowCount(), this
+      makes the scroll bar size stable
+    - fetching from the database in data() only the page of rows containing
+      the requested row
+    - caching the most recently used pages, forgetting the least recently used
+      ones so memory doesn't grow as the table is scrolled
 
     Sorting is done by regenerating the query with the sort clauses and
     resetting the model, this causes UI to be disturbed (ie row
@@ -172,54 +290,64 @@ class TableModel(QAbstractTableModel):
 
     It's always the case that
 
-        total_row_count >= loaded_row_count
-        total_row_count = len(data)
-        0 < loaded_row_count
-
-    XXX Ideally for virtual/infinite data, would like a different mechanism
-        where:
+        total_row_count >= filtered_row_count
 
-        - rowCount() returns total_row_count. This makes the scroll bar size stable
-        - a viewport height worth of rows is fetched as the table is scrolled up
-          or down, forgetting the rows before or after those (modulo guardband)
-        - 
+    XXX Pages are fetched with LIMIT/OFFSET, sqlite needs to step over the
+        skipped rows so pages far down a large result are slower to fetch.
+        Large selections (eg select all) don't go through the pages, see
+        getFilepaths
 
+    XXX Rows inserted or deleted by the worker are not reflected until the
+        next reset, and pages of rows deleted by the worker may come back
+        shorter than expected, see getRow
     """
 
-    def __init__(self, data, headers):
+    def __init__(self, headers):
         super(TableModel, self).__init__()
-        self.data = data
         self.headers = headers
         self.filter_words = []
+        # Number of rows fetched at once, and number of most recently used
+        # pages kept in memory, see getRow
+        self.page_size = 256
+        self.max_cached_pages = 64
+        self.pages = collections.OrderedDict()
         self.sort_orders = collections.OrderedDict(
             reversed(((2, Qt.DescendingOrder), (1, Qt.AscendingOrder), (0, Qt.AscendingOrder), (3, Qt.DescendingOrder)))
         )
         
-        self.conn = sqlite3.connect(database_filepath)
-        self.cursor = None
-        
-        self.reset()
+        self.conn = connect_db()
+        # Rowids matching the filter words in filtered_words, see
+        # updateFilteredRowids
+        self.conn.execute("CREATE TEMP TABLE filtered_rowids(id INTEGER PRIMARY KEY)")
+        self.filtered_words = None
+        # Cached since it's needed on every reset, recounted on the next reset
+        # when dirty, see invalidateTotalRowCount
+        self.total_row_count = 0
+        self.total_row_count_dirty = True
+        # Use the trigram index for filtering if main() managed to create it
+        # Note main() drops the triggers if this sqlite doesn't support the
+        # index, check them instead of the index table
+        self.use_fts = (self.conn.execute(
+            "SELECT count(*) FROM sqlite_master WHERE name = 'files_fts_insert'").fetchone()[0] > 0)
+        info("Using full text search index %s", self.use_fts)
 
-    def createIndex(self, *args, **kwargs):
-        dbg("createIndex %s", [a for a in args])
-        return super(TableModel, self).createIndex(*args, **kwargs)
+        self.reset()
 
-    def index(self, row, col, parent):
-        dbg("index %d %d", row, col)
-        return super(TableModel, self).index(row, col, parent)
-        
+    # Note index() and createIndex() are not overridden, Qt calls them for
+    # every cell so overriding them in Python makes every call go through the
+    # interpreter
 
     def data(self, ix, role):
         # Data gets called by columns: all visible rows for column 1, all
         # visible rows for column 2, etc
+        # Note this is also called for every cell with many other roles
+        # (font, alignment, size hint...) so don't do any work, not even
+        # logging, before checking the role
         if (role == Qt.DisplayRole):
             
-            # XXX Use a data "window" to minimize memory footprint? instead of
-            #     storing all the elements from the beginning to this point (but
-            #     requires to redo the query when moving the window to previous
-            #     rows)
-            row = self.data[ix.row()]
-            dbg("data %d %d %d", ix.row(), ix.column(), row[-1])
+            row = self.getRow(ix.row())
+            if (row is None):
+                return None
             value = row[ix.column()]
             if (ix.column() == 2):
                 if (value == -1):
@@ -229,100 +357,113 @@ class TableModel(QAbstractTableModel):
                     # File, convert size into human friendly units
                     value = size_to_human_friendly_units(value)
             elif (ix.column() == 3):
-                # Truncate to seconds for display
-                value = str(datetime.datetime.fromtimestamp(value/1000))
+                # Truncate to seconds for display. Note data() is called for
+                # every visible cell on every repaint, the conversion is cached
+                value = mtime_to_string(value)
             return value
 
-    def loadedRowCount(self):
+    def filteredRowCount(self):
         """
-        Number of rows on-demand loaded <= totalRowCount
+        Number of rows matching the filter <= totalRowCount
         """
-        return self.loaded_row_count
+        return self.filtered_row_count
 
     def totalRowCount(self):
         """
-        Total number of rows in data
+        Total number of rows in the database as of the last reset
         """
         return self.total_row_count
 
-    def canFetchMore(self, parent):
-        dbg("canFetchMore %d, %d", self.loaded_row_count, len(self.data))
-        if (parent.isValid()):
-            dbg("parent is valid")
-            return False
-        
-        return not self.end_of_cursor
+    def invalidateTotalRowCount(self):
+        """
+        Force the total row count to be recalculated on the next reset, needs
+        to be called when the database is modified
 
-    def internalGetFilepath(self, row):
-        filename = self.data[row][0]
-        dirpath = self.data[row][1]
-    
-        filepath = os.path.join(dirpath, filename)
+        Note the stale count is kept until then, since it can still be
+        displayed if there's no reset (eg the filter didn't change)
+        """
+        self.total_row_count_dirty = True
 
-        return filepath
-        
+    def invalidateFilteredRowids(self):
+        """
+        Force the next filter change to filter the whole table instead of
+        refining the stored rowids, needs to be called when the database is
+        modified
 
-    def filterMoreRows(self, count):
+        The files table rowids are not AUTOINCREMENT, so sqlite can reuse the
+        rowid of a file deleted by the worker for an unrelated new file, which
+        would then show up in the refined matches even if it doesn't match
         """
-        Load more rows using the current cursor (with the filter and sort SQL
-        query) and update data, loaded_row_count and end_of_cursor
+        self.filtered_words = None
+
+    def isFtsWord(self, filter_word):
         """
-        dbg("filterMoreRows %d", count)
-        if (not self.end_of_cursor):
-            # XXX This next iterator can take some time (eg when the word is
-            #     not found and a full table scan is needed), should send a
-            #     message to the view so it can update the status bar
-            # XXX Will probably also need to do it in a different thread?
-            # XXX Filtering can take some time, ideally would like to 
-            #       QApplication.processEvents() 
-            #     here, but it causes different errors because processEvents may
-            #     cause reentrant calls to fetchMore which were not easy to fix.
-            #     (looks like processEvents causes more calls to fetchMore while
-            #     still inside fetchMore).
-            #     Another option is to move the filtering to a thread and send a
-            #     signal when the filtering is done but would probably cause UX
-            #     problems (eg user scrolls down, filtering is deferred so it can't
-            #     scroll, rows are added, but cursor is not scrolled down)
-            #     Would need some kind of async prefetch and block if ever
-            #     scrolls ahead of the prefetch
-            new_data = self.cursor.fetchmany(count)
-            self.loaded_row_count += len(new_data)
-            self.data.extend(new_data)
-            self.end_of_cursor = (len(new_data) < count)
-            
-                
-    def fetchMore(self, parent):
-        dbg("fetchMore %d %d %d %d", self.loaded_row_count, self.totalRowCount(), parent.row(), parent.column())
-        if (parent.isValid()):
-            warn("index is valid")
-            return False
+        Filter words are matched verbatim (no wildcards) and case-insensitively
+        for ASCII letters only, which is what LIKE does once the wildcards are
+        escaped. The trigram index matches the same way for ASCII words, but
+        case folds non-ASCII letters too, so words with non-ASCII characters
+        go through LIKE so the matches don't depend on the path taken.
+
+        The trigram index can only match words of three or more characters,
+        shorter words need to go through LIKE (note LIKE on the fts table would
+        also use the index but only for three or more characters too)
+
+        @return {bool} True if filter_word is matched using the trigram index,
+                False if using LIKE
+        """
+        return (
+            self.use_fts and (len(filter_word) >= 3) and 
+            all([(ord(c) < 128) for c in filter_word])
+        )
 
-        loaded_row_count = self.loaded_row_count
+    def getRow(self, row):
+        """
+        Fetch the page containing the given row if not cached and return the
+        row.
+
+        @return {tuple} (name, path, size, mtime, rowid) or None if the row
+                doesn't exist anymore (eg deleted by the worker after the reset)
+        """
+        i_page = row // self.page_size
+        page = self.pages.pop(i_page, None)
+        if (page is None):
+            dbg("fetching page %d", i_page)
+            page = self.conn.execute(self.sql_query_string + " LIMIT ? OFFSET ?", 
+                self.sql_query_params + [self.page_size, i_page * self.page_size]).fetchall()
+            if (len(self.pages) >= self.max_cached_pages):
+                # Forget the least recently used page
+                self.pages.popitem(last=False)
+        # (Re)insert the page last so it becomes the most recently used
+        self.pages[i_page] = page
+
+        i_row = row - i_page * self.page_size
+        if (i_row >= len(page)):
+            return None
+        
+        return page[i_row]
 
-        # Don't use too big of a number since Qt will call fetchMore as many
-        # times as necessary to fill the viewport, and using a big number causes
-        # costly skipping for rows that could end up outside of the viewport
-        # anyway
-        fetch_batch_size = 5
-        self.filterMoreRows(fetch_batch_size)
+    def internalGetFilepath(self, row):
+        row = self.getRow(row)
+        if (row is None):
+            return None
 
-        self.beginInsertRows(parent, loaded_row_count, self.loaded_row_count - 1)
-        self.endInsertRows()
+        filename = row[0]
+        dirpath = row[1]
+    
+        filepath = os.path.join(dirpath, filename)
 
+        return filepath
 
     def rowCount(self, index):
         if (index.isValid()):
             dbg("index is valid")
             return 0
 
-        # Returning the currently loaded count causes the vertical scroll bar
-        # position to change as new entries are loaded. This is not ideal, would
-        # like to return the total count here in order to have a stable vertical
-        # scroll bar, but that's not possible with on-demand row loading via
-        # canFetchMore/fetchMore. An option would be to move on demand loading
-        # to the data() method, but if resizeColumnsToContents() is used, QT
-        # will traverse the full rowCount to find the content to resize to
-        return self.loaded_row_count
+        # Return the full count so the vertical scroll bar is stable, rows are
+        # loaded on demand in data()
+        # Note this means resizeRowsToContents() must not be used since QT
+        # would traverse the full rowCount to find the content to resize to
+        return self.filtered_row_count
 
     def columnCount(self, ix):
         return len(self.headers)
@@ -335,23 +476,63 @@ class TableModel(QAbstractTableModel):
 
     def getFilepath(self, ix):
         return self.internalGetFilepath(ix.row())
+
+    def getFilepaths(self, rows):
+        """
+        Get the filepaths of the given rows with a single query.
+
+        Going through getRow for many rows (eg select all) would fetch every
+        page with its own OFFSET, stepping over all the previous rows each time,
+        and would evict the cached pages of the visible rows.
+
+        @return {list} filepaths of the rows sorted by row, rows that don't
+                exist anymore (eg deleted by the worker after the reset) are
+                skipped
+        """
+        filepaths = []
+        if (len(rows) == 0):
+            return filepaths
+
+        rows = sorted(rows)
+        first_row = rows[0]
+        cursor = self.conn.execute(self.sql_query_string + " LIMIT ? OFFSET ?", 
+            self.sql_query_params + [rows[-1] - first_row + 1, first_row])
+        i_row = 0
+        for row_index, row in enumerate(cursor, first_row):
+            if (row_index == rows[i_row]):
+                filepaths.append(os.path.join(row[1], row[0]))
+                i_row += 1
+                if (i_row >= len(rows)):
+                    break
+        cursor.close()
+
+        return filepaths
         
     def reset(self):
-        if (self.cursor is not None):
-            self.cursor.close()
-
+        # Counting is a full index scan, only do it if the worker modified the
+        # database since the last count
         # XXX total_row_count should be updated in other places without needing
-        #     to refresh the filter to update it (eg when receiving the signal
-        #     that rows have been inserted/directories traversed?)
-        self.total_row_count = self.conn.execute("SELECT count(*) FROM files").fetchone()[0]
+        #     to refresh the filter to update it
+        if (self.total_row_count_dirty):
+            self.total_row_count = self.conn.execute("SELECT count(*) FROM files").fetchone()[0]
+            self.total_row_count_dirty = False
 
         # Build the filter clause
         filter_params = []
         filter_clause = ""
         if (len(self.filter_words) > 0):
             filter_clauses = []
+            fts_words = []
             for filter_word in self.filter_words:
-                filter_params.append(filter_word)
+                if (self.isFtsWord(filter_word)):
+                    # Quote as FTS5 string so the word is matched verbatim
+                    # instead of parsed as FTS5 query syntax
+                    fts_words.append('"%s"' % filter_word.replace('"', '""'))
+                    continue
+
+                # Escape the LIKE wildcards so the word is matched verbatim,
+                # same as with the trigram index
+                filter_params.append(filter_word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
                 # XXX Allow verbatim here when surrounded by quotation marks
                 #     This means not using "%" prefix and/or suffix in the LIKE
                 #     clause or not using a LIKE clause if there are start and
@@ -389,8 +570,27 @@ class TableModel(QAbstractTableModel):
                 #     expecting that the first m columns will have discarded
                 #     most of the data
 
-                filter_clauses.append("((path || \"" + os.sep + "\" || name) LIKE (\"%\" || ? || \"%\"))")
-            filter_clause = " WHERE %s" % string.join(filter_clauses, " AND ")
+                filter_clauses.append("((path || \"" + os.sep + "\" || name) LIKE (\"%\" || ? || \"%\") ESCAPE '\\')")
+
+            if (len(fts_words) > 0):
+                # Trigram matching is case-insensitive, same as LIKE for the
+                # ASCII words matched here, see isFtsWord. Put it first so the cheap index lookup is done before the LIKE scans
+                filter_params.insert(0, " AND ".join(fts_words))
+                filter_clauses.insert(0, "(rowid IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?))")
+
+            # Store the matching rowids in a temporary table and query from
+            # that, this allows refining the matches of the previous filter
+            # instead of scanning the whole table again
+            self.updateFilteredRowids(" AND ".join(filter_clauses), filter_params)
+            filter_params = []
+            filter_clause = " WHERE rowid IN (SELECT id FROM temp.filtered_rowids)"
+            self.filtered_row_count = self.conn.execute("SELECT count(*) FROM temp.filtered_rowids").fetchone()[0]
+
+        else:
+            self.filtered_words = None
+            self.conn.execute("DELETE FROM temp.filtered_rowids")
+            self.conn.commit()
+            self.filtered_row_count = self.total_row_count
 
         # Build the order clause
         order_clause = ""
@@ -401,30 +601,83 @@ class TableModel(QAbstractTableModel):
             sort_order = self.sort_orders[sort_section]
             order_clauses.append(" %s%s" % (sort_sections[sort_section],
             "" if (sort_order == Qt.AscendingOrder) else " DESC"))
-        order_clause = " ORDER BY%s" % string.join(order_clauses, ",")
-
-        sql_query_string = "SELECT *, rowid FROM files%s%s" % (filter_clause, order_clause)
-        info("Filter query %r params %s", sql_query_string, filter_params)
-        self.cursor = self.conn.execute(sql_query_string, filter_params)
+        order_clause = " ORDER BY%s" % ",".join(order_clauses)
 
-        self.end_of_cursor = False
-        self.data = []
+        self.sql_query_string = "SELECT name, path, size, mtime, rowid FROM files%s%s" % (filter_clause, order_clause)
+        self.sql_query_params = filter_params
+        info("Filter query %r params %s", self.sql_query_string, self.sql_query_params)
 
-        self.loaded_row_count = 0
+        # Pages will be fetched with the new query as data() requests them
+        self.pages.clear()
         
 
-    def setFilter(self, filter):
-        # XXX This rebuilds the query from scratch, in the normal case
-        #     the filter is typed sequentially and the old filter is a superset
-        #     of the new filter (less or longer words), could store the result
-        #     in a table and fetch from that table if the new filter is a subset?
+    def updateFilteredRowids(self, filter_clause, filter_params):
+        """
+        Store in the filtered_rowids temporary table the rowids of the files
+        that match filter_clause.
+
+        In the normal case the filter is typed sequentially and the new filter
+        words refine the previous ones (more or longer words). When every
+        previous word is contained in some new word, the new matches are a
+        subset of the stored ones and only those need to be filtered again,
+        instead of doing a full table scan.
+
+        The subset only holds if both words are matched the same way, so a
+        previous word only counts as contained if it goes through the same
+        matcher (trigram index or LIKE) as the new word, see isFtsWord. The
+        trigram index is fast enough that not refining when a word becomes
+        long enough to use it is not a problem.
+
+        Note the stored rowids are discarded when the worker modifies the
+        database, see invalidateFilteredRowids
+        """
+        if (self.filtered_words == self.filter_words):
+            # Same filter (eg when sorting), nothing to do
+            return
+
+        if ((self.filtered_words is not None) and 
+            all([any([((old_word in new_word) and (self.isFtsWord(old_word) == self.isFtsWord(new_word)))
+                for new_word in self.filter_words]) for old_word in self.filtered_words])):
+            info("Refining filtered rowids from %s to %s", self.filtered_words, self.filter_words)
+            self.conn.execute("DELETE FROM temp.filtered_rowids WHERE NOT EXISTS "
+                "(SELECT 1 FROM files WHERE (rowid = filtered_rowids.id) AND %s)" % filter_clause, 
+                filter_params)
 
-        self.filter_words = filter.split()
+        else:
+            info("Storing filtered rowids for %s", self.filter_words)
+            self.conn.execute("DELETE FROM temp.filtered_rowids")
+            self.conn.execute("INSERT INTO temp.filtered_rowids SELECT rowid FROM files WHERE %s" % filter_clause, 
+                filter_params)
+        
+        # Commit so this connection doesn't hold a stale read transaction
+        self.conn.commit()
+        self.filtered_words = self.filter_words
+        
+    def setFilter(self, filter):
+        """
+        @return {bool} True if the model was reset with the new filter, False
+                if the filter words didn't change and the database wasn't
+                modified since the last reset
+        """
+        filter_words = filter.split()
+        # The worker invalidates the row count and the filtered rowids when it
+        # modifies the database, re-running the same filter needs to reset to
+        # pick up the new rows in that case
+        invalidated = (self.total_row_count_dirty or 
+            ((len(filter_words) > 0) and (self.filtered_words is None)))
+        if ((filter_words == self.filter_words) and (not invalidated)):
+            # Nothing to do (eg only whitespace was typed), don't reset the
+            # model so the selection is preserved
+            dbg("ignoring same filter words %s", filter_words)
+            return False
+        self.filter_words = filter_words
         self.beginResetModel()
         # XXX This should try to preserve the focused and selected rows
         self.reset()
         self.endResetModel()
 
+        return True
+
     def sort(self, section, sort_order, ignore_redundant = True):
         info("sort %d %d", section, sort_order)
 
@@ -442,16 +695,13 @@ class TableModel(QAbstractTableModel):
             # (although this is not that important because DB sorting is
             # relatively fast)
             
-            # XXX With DB, sorting also rebuilds the filter, and if the filter
-            #     causes a full table scan then sorting won't be fast, does it
-            #     make sense to store into a temp table and then re-sort the
-            #     temp table instead. This will turn any filter change into a
-            #     full table scan (bad), but if the new filter string is a
-            #     superset of the previous filter string (usual) then only the
-            #     temporary table would need to be re-filtered, which not only
-            #     would be fast but would also benefit the current (common) worst case 
-            #     which is when a filter word is entered with no matches, which 
-            #     causes a full table scan.
+            # Note the filter matches are stored in a temp table which is
+            # reused when sorting, so sorting doesn't re-run the filter. This
+            # turns any non-refining filter change into a full table scan
+            # (unless the trigram index is used), but refining filter changes
+            # (the usual case when typing) only re-filter the temp table, which
+            # also makes fast the common worst case of a filter word with no
+            # matches.
             
             # Store the sort_orders lower priority first, sorting by different 
             # columns can be done by consecutively calling sort() for each column
@@ -461,7 +711,7 @@ class TableModel(QAbstractTableModel):
                 (len(self.sort_orders) == 0) or 
                 # This section is not already the highest priority or, if it is,
                 # it had a different order
-                (self.sort_orders.keys()[-1] != section) or
+                (next(reversed(self.sort_orders)) != section) or
                 (self.sort_orders[section] != sort_order)):
 
                 # Remove and add the sort order so it becomes last in the
@@ -514,43 +764,45 @@ class TableView(QTableView):
         self.addAction(self.copyFilesAct)
         self.addAction(self.cutFilesAct)
 
+    def getSelectedRowFilepaths(self):
+        # selectedIndexes() returns one index per selected cell, use
+        # selectedRows() which returns one index per fully selected row (rows
+        # are always fully selected since the selection behavior is SelectRows)
+        return self.model().getFilepaths([ix.row() for ix in self.selectionModel().selectedRows(0)])
+
     def getSelectedFilepaths(self):
-        filepaths = []
-        # XXX Could also do selectedRows(column)? (but that method doesn't seem
-        #     to be available?)
-        for ix in self.selectedIndexes():
-            # Note for each row there's a selection per column, only copy
-            # one filepath per row
-            if (ix.column() == 0):
-                filepath = self.model().getFilepath(ix)
-                filepaths.append(filepath)
-                
-                self.filepathCopied.emit(filepath)
+        filepaths = self.getSelectedRowFilepaths()
+        for filepath in filepaths:
+            self.filepathCopied.emit(filepath)
 
         return filepaths
 
+    def launchFilepath(self, filepath):
+        info("launchFilepath %r", filepath)
+        launch_with_preferred_app(filepath)
+
+        self.defaultAppLaunched.emit(filepath)
+
     def launchWithPreferredApp(self, ix):
         
         filepath = self.model().getFilepath(ix)
-        info("launchWithPreferredApp %r", filepath)
+        if (filepath is None):
+            return
         
-        launch_with_preferred_app(filepath)
-
-        self.defaultAppLaunched.emit(filepath)
+        self.launchFilepath(filepath)
 
     def launchSelectedFilepaths(self):
-        # XXX Could also do selectedRows(column)?
-        for ix in self.selectedIndexes():
-            # Note for each row there's a selection per column, only copy
-            # one filepath per row
-            if (ix.column() == 0):
-                self.launchWithPreferredApp(ix)
+        for filepath in self.getSelectedRowFilepaths():
+            self.launchFilepath(filepath)
 
     def copySelectedFilepaths(self):
         filepaths = self.getSelectedFilepaths()
         logger.info("Copying filepaths %r", filepaths)
+        if (len(filepaths) == 0):
+            # Don't clear the clipboard if there's nothing selected
+            return
         clipboard = qApp.clipboard()
-        clipboard.setText(string.join(filepaths, "\n"))
+        clipboard.setText("\n".join(filepaths))
 
     def cutCopySelectedFiles(self, cut = False):
         # XXX Do something to gray out if cutting? (note the file doesn't really
@@ -577,7 +829,7 @@ class TableView(QTableView):
             # Gnome, LXDE, and XFCE
             # Note url.toString() returns unicode but QByteArray won't take
             # unicode, convert to utf-8
-            u = u"cut\n" + str.join("\n", [url.toString() for url in urls]) + "\n"
+            u = u"cut\n" + "\n".join([url.toString() for url in urls]) + "\n"
             mimeData.setData("x-special/gnome-copied-files", QByteArray(u.encode("utf-8")))
 
         qApp.clipboard().setMimeData(mimeData)
@@ -587,7 +839,7 @@ class TableView(QTableView):
 
     def cutSelectedFiles(self):
         self.cutCopySelectedFiles(True)
-        
+
     def contextMenuEvent(self, event):
         self.menu = QMenu(self)
 
@@ -610,10 +862,7 @@ class TableView(QTableView):
 
 class MainWindow(QMainWindow):
     # XXX Add option to create new window/instance? Allow multiple instances of
-    #     the app and move the db update to a different process?
-    #     Moving the db update to a different process will also remove the UI
-    #     stalls due to the GIL when the db is updating.
-    #     see https://stackoverflow.com/questions/26746379/how-to-signal-slots-in-a-gui-from-a-different-process
+    #     the app?
     # XXX Add server mode
     # XXX Add client mode (for launching apps, a mapping from server local dir
     #     to client remote share will be needed, or the server can serve the
@@ -644,7 +893,19 @@ class MainWindow(QMainWindow):
             combo.lineEdit().returnPressed.connect(self.updateFilter)
 
         else:
-            combo.lineEdit().textEdited.connect(self.updateFilter)
+            # Filtering is done in the UI thread and can take a while if it
+            # needs a table scan, don't filter on every keystroke but when the
+            # user stops typing for a short while
+            # XXX Filtering could be done in a different thread, but the
+            #     filtered rowids are stored in a temp table which is only
+            #     visible to the model's connection
+            timer = QTimer()
+            timer.setSingleShot(True)
+            timer.setInterval(150)
+            timer.timeout.connect(self.updateFilter)
+            self.filter_timer = timer
+            # start() restarts the timer if already active
+            combo.lineEdit().textEdited.connect(lambda s: self.filter_timer.start())
         self.combo = combo
         h.addWidget(combo, 1)
 
@@ -655,9 +916,11 @@ class MainWindow(QMainWindow):
             h.addWidget(button, 0)
             self.scan_button = button
 
-        entries = []
+        # Start the database update before the model opens its connection, see
+        # start_update_process
+        update_process, update_message_queue = start_update_process(sys.argv[1].split(","))
 
-        model = TableModel(entries, ["Name", "Path", "Size", "Date"])
+        model = TableModel(["Name", "Path", "Size", "Date"])
         self.model = model
 
         table = TableView()
@@ -674,10 +937,19 @@ class MainWindow(QMainWindow):
         table.setSortingEnabled(True)
         table.setSelectionBehavior(QTableView.SelectRows)
         table.setTabKeyNavigation(False)
-        # Flag the table to be resized to content when the first rows are
-        # inserted. Resize only at startup, don't mess with the size set by the
-        # user after startup
-        self.resize_table_to_contents = True
+        # Resize the table to the content of the first rows. Resize only at
+        # startup, don't mess with the size set by the user after startup
+        # Note the table is not shown yet, so QT uses up to
+        # resizeContentsPrecision() rows (1000 by default) for resizing
+        # columns, not just the visible ones
+        table.resizeColumnsToContents()
+        # The database is empty on the first run, there's no row to take the
+        # height from, keep QT's default row height in that case
+        if (model.filteredRowCount() > 0):
+            table.resizeRowToContents(0)
+            # Now that there's a minimum row height, set that one as default
+            # for all rows
+            table.verticalHeader().setDefaultSectionSize(table.rowHeight(0))
         # Set the name column to stretch if the wider is larger than the table
         # Note this prevents resizing the name column, but other columns can be
         # resized and the name column will pick up the slack
@@ -685,7 +957,6 @@ class MainWindow(QMainWindow):
         table.doubleClicked.connect(table.launchWithPreferredApp)
         table.filepathCopied.connect(lambda s: self.showMessage("Copied path %s" % s, 2000))
         table.defaultAppLaunched.connect(lambda s: self.showMessage("Launched %s" % s, 2000))
-        model.rowsInserted.connect(self.onRowsInserted)
         self.table = table
 
         l.addWidget(table)
@@ -736,7 +1007,7 @@ class MainWindow(QMainWindow):
         #     https://stackoverflow.com/questions/71834240/how-to-debug-pyqt5-threads-in-visual-studio-code
         #     https://code.visualstudio.com/docs/python/debugging#_troubleshooting
         self.thread = QThread()
-        self.worker = Worker()
+        self.worker = Worker(update_process, update_message_queue)
         
         # Step 4: Move worker to the thread
         self.worker.moveToThread(self.thread)
@@ -752,6 +1023,13 @@ class MainWindow(QMainWindow):
         self.thread.finished.connect(self.thread.deleteLater)
 
         self.worker.traversing.connect(self.showMessage, connection_type)
+        # The worker sends a modified message after every commit that changed
+        # the database, also invalidate when finished in case the worker
+        # process died before sending it
+        self.worker.modified.connect(self.model.invalidateTotalRowCount, connection_type)
+        self.worker.modified.connect(self.model.invalidateFilteredRowids, connection_type)
+        self.worker.finished.connect(self.model.invalidateTotalRowCount, connection_type)
+        self.worker.finished.connect(self.model.invalidateFilteredRowids, connection_type)
         
         # XXX Setting Idle priority doesn't seem to make any difference to the
         #     UI freezes, docs say in Linux priority is not supported?
@@ -769,18 +1047,6 @@ class MainWindow(QMainWindow):
     def clearMessage(self):
         self.status_message_widget.setText("")
 
-    def onRowsInserted(self, index, start, end):
-        dbg("onRowsInserted %d %d %d %d", index.row(), index.column(), start, end)
-        if (self.resize_table_to_contents):
-            info("resizing using %d loaded rows", self.table.model().loadedRowCount())
-            self.table.resizeColumnsToContents()
-            self.table.resizeRowsToContents()
-            # Now that there's a minimum row height, set that one as default for
-            # future rows
-            self.table.verticalHeader().setDefaultSectionSize(self.table.rowHeight(0))
-            self.resize_table_to_contents = False
-        self.updateStatusBar()
-
     def sortModel(self, section, sort_order):
         # XXX This could preserve the selection and focus by saving before sort
         #     and restoring aftersort?
@@ -789,11 +1055,8 @@ class MainWindow(QMainWindow):
         self.clearMessage()
         
     def updateStatusBar(self):
-        # Display a "?" indicator if there are still rows to load
-        c = "" if self.model.end_of_cursor else "?"
-        self.status_count_widget.setText("%d%s/%d" % (
-            self.model.loadedRowCount(), 
-            c,
+        self.status_count_widget.setText("%d/%d" % (
+            self.model.filteredRowCount(), 
             self.model.totalRowCount()
         ))
 
@@ -801,9 +1064,11 @@ class MainWindow(QMainWindow):
         filter = self.combo.lineEdit().text()
         
         self.showMessage("Filtering...")
-        self.model.setFilter(filter)
+        reset = self.model.setFilter(filter)
         self.clearMessage()
-        self.updateStatusBar()
+        # The counts only change when the model was reset
+        if (reset):
+            self.updateStatusBar()
 
 
 def is_enoent(e):
@@ -815,14 +1080,101 @@ def is_enoent(e):
     #   errno for this one is ENOENT
     return (
         (e.errno == errno.ENOENT) and
-        # WinError doesn't exist on Unix, guard against that
-        ((e.__class__.__name__ != "WindowsError") or (e.winerror != 53))
+        # winerror doesn't exist on Unix, guard against that
+        (getattr(e, "winerror", None) != 53)
     )
 
-class Worker(QObject):
-    traversing = pyqtSignal(str)
-    finished = pyqtSignal()
-    started = pyqtSignal(str)
+def get_subtree_path_range(dirpath):
+    """
+    Get the range of the path column for the entries below dirpath, ie
+    inside dirpath's subdirectories. This doesn't include the entries directly
+    inside dirpath, whose path is dirpath itself.
+
+    Note the range doesn't depend on the sort order of the path separator, see
+    DbUpdater.update_db. os.path.join is used to add the separator so roots
+    (which already end in a separator) work too.
+
+    @return {tuple} (prefix, prefix_end) so entries below dirpath have
+            prefix <= path < prefix_end
+    """
+    prefix = os.path.join(dirpath, "")
+
+    return (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+def list_subdir(subdirpath):
+    """
+    Get the mtime, the sorted filenames and the stats of the filenames of
+    subdirpath.
+
+    This is called from the listing thread pool so filesystem latencies of
+    different directories overlap, the GIL is released while waiting on the
+    filesystem.
+
+    @return {tuple} (subdirpath_mtime, filenames, filestats) or None if there
+            was an error, in which case the caller needs to list the directory
+            itself and handle the error
+    """
+    try:
+        # Get the mtime before listing so changes done while listing are
+        # detected on the next update
+        subdirpath_mtime = int(os.path.getmtime(subdirpath) * 1000.0)
+        if (scandir is not None):
+            entries = sorted(scandir(subdirpath), key=lambda entry: entry.name)
+            filenames = [entry.name for entry in entries]
+            filestats = [entry.stat() for entry in entries]
+
+        else:
+            filenames = os.listdir(subdirpath)
+            filenames.sort()
+            filestats = [os.stat(os.path.join(subdirpath, filename)) for filename in filenames]
+
+    except OSError as e:
+        dbg("Error %r prefetching subdirpath %r, ignoring", e, subdirpath)
+        return None
+
+    return (subdirpath_mtime, filenames, filestats)
+
+class DbUpdater(object):
+    """
+    Update the database with the contents of the filesystem. This runs in a
+    child process, see update_dbs, so progress is reported as (message, arg)
+    tuples sent to message_queue instead of Qt signals
+    """
+    def __init__(self, message_queue):
+        self.message_queue = message_queue
+        self.last_traversing_message_time = 0
+        # Use the same connections for all the dirpaths instead of opening new
+        # ones for each, see close
+        self.conn = connect_db()
+        self.read_conn = connect_db()
+        # Value of conn.total_changes at the last "modified" message, see
+        # commit
+        self.committed_changes = 0
+
+    def commit(self):
+        """
+        Commit the changes and send a "modified" message if any rows were
+        changed since the last one.
+
+        The message is not throttled like the traversing messages, the UI needs
+        to know about every commit so it doesn't keep using stale filter
+        results.
+        """
+        self.conn.commit()
+        if (self.conn.total_changes != self.committed_changes):
+            self.committed_changes = self.conn.total_changes
+            self.message_queue.put(("modified", None))
+
+    def close(self):
+        """
+        Close the database connections, call once all the dirpaths have been
+        updated.
+        """
+        # Let sqlite update the query planner statistics if the update changed
+        # them enough (ignored by older sqlite versions)
+        self.conn.execute("PRAGMA optimize;")
+        self.conn.close()
+        self.read_conn.close()
 
     def update_db_subdir(self, conn, read_cursor, subdirpath, row):
         """
@@ -880,52 +1232,68 @@ class Worker(QObject):
         #     update the database, or collect the database updates and send them
         #     to the database writer thread
         
-        # XXX db updates should be moved to a different process, they cause UI
-        #     stalls when ingesting remote  directories with lots of files.
-        
-        # This is a hotpath when no updates are found but at least on laptop
-        # this emit makes no difference at all even with lots of subdirs
-        self.traversing.emit(subdirpath)
+        # This is a hotpath when no updates are found, every message costs a
+        # queue put here plus a signal and a status bar repaint in the UI, and
+        # the UI can't show more than one message per frame anyway, only send
+        # the message if enough time passed since the last one
+        now = time.time()
+        if ((now - self.last_traversing_message_time) >= traversing_message_interval):
+            self.last_traversing_message_time = now
+            self.message_queue.put(("traversing", subdirpath))
 
         # Get the mtime for this specific path, we could use the mtime for the
         # global dirpath, but that one is not updated in the database until the
         # whole dirpath has been updated, so using this specific path allows fine
         # grain committing and avoiding doing the work again if it's aborted for
         # some reason.
-        subdirpath_max_mtime = conn.execute("SELECT mtime FROM files WHERE ((path == ?) AND (name = ?))", 
-            [os.path.dirname(subdirpath), os.path.basename(subdirpath)]).fetchone()
+        # This is a hotpath when no updates are found, the mtimes of all the
+        # directories were fetched with a single query in update_db, use those
+        # instead of querying the database for each subdirpath
+        # Split once, the (path, name) key of this subdirpath is needed again
+        # when updating its mtime
+        subdirpath_key = os.path.split(subdirpath)
+        subdirpath_max_mtime = self.dir_mtimes.get(subdirpath_key)
         if (subdirpath_max_mtime is None):
             # This is None when a directory was deleted from the filesystem,
             # detected and deleted from the database when traversin the parent,
             # but children are still around in the database so the directory
-            # is picked up again in the outer loop.
+            # is picked up again in the outer loop. It's also None for new
+            # directories inserted during this update, those have a zero mtime
+            # in the database anyway.
             # XXX The outer loop should only pick directories and not try to
             #     work them out from files? (leftover from when only files were
             #     stored)
-            info("None SELECT mtime, deleting children for subdirpath %r", subdirpath)
+            dbg("None mtime for subdirpath %r", subdirpath)
 
             subdirpath_max_mtime = 0
-            # Fall through, this will hit two exceptions below, one to getmtime,
-            # the other to listdir and proceed to delete all children one by
-            # one
+            # Fall through, if the directory was deleted this will hit two
+            # exceptions below, one to getmtime, the other to listdir and
+            # proceed to delete the subtree
 
-        else:
-            # Note this could be 0 if this directory was never traversed so the
-            # db entry has zero to force the traversal
-            subdirpath_max_mtime = subdirpath_max_mtime[0]
+        # Note this could be 0 if this directory was never traversed so the
+        # db entry has zero to force the traversal
 
         # This triggers an exception if the subdirpath has been removed, in that
         # case the subdirpath was already deleted from the database, but don't
         # early exit since the children still need to be deleted
 
-        # XXX Delete all children by using a single prefix query? (but needs to
-        #     redo the outer query or will still be found here again)
         # XXX This time was already recovered somewhere, find where and don't
         #     fetch it?
+        listing = None
+        async_listing = self.prefetched_listings.pop(subdirpath, None)
+        if (async_listing is not None):
+            dbg("waiting for prefetched listing %r", subdirpath)
+            listing = async_listing.get()
+            dbg("waited for prefetched listing %r", subdirpath)
+        
         try:
-            dbg("getmtiming sd %r", subdirpath)
-            subdirpath_mtime = int(os.path.getmtime(subdirpath) * 1000.0)
-            dbg("getmtimed sd %r", subdirpath)
+            if (listing is not None):
+                subdirpath_mtime = listing[0]
+
+            else:
+                dbg("getmtiming sd %r", subdirpath)
+                subdirpath_mtime = int(os.path.getmtime(subdirpath) * 1000.0)
+                dbg("getmtimed sd %r", subdirpath)
 
         except OSError as e:
             exc("Error %r calling getmtime for subdirpath %r, raising if not ENOENT %d vs %d", 
@@ -951,14 +1319,29 @@ class Worker(QObject):
         #     See https://stackoverflow.com/questions/1025187/rules-for-date-modified-of-folders-in-windows-explorer
         #     See https://web.archive.org/web/20080219020154/http://support.microsoft.com/kb/299648
         if (subdirpath_mtime > subdirpath_max_mtime):
+            refresh_read_cursor = False
             try:
                 # XXX This fails with long paths on Windows, need to use long
                 #     path prefix, see
                 #     https://stackoverflow.com/questions/18390341/unable-to-locate-files-with-long-names-on-windows-with-python
                 dbg("listdiring %r", subdirpath)
-                filenames = os.listdir(subdirpath)
+                filestats = None
+                entries = None
+                if (listing is not None):
+                    filenames = listing[1]
+                    filestats = listing[2]
+
+                elif (scandir is not None):
+                    # Keep the entries around, on Windows the directory read
+                    # already returns the stat information so new entries
+                    # don't need to be stat'ed again
+                    entries = sorted(scandir(subdirpath), key=lambda entry: entry.name)
+                    filenames = [entry.name for entry in entries]
+
+                else:
+                    filenames = os.listdir(subdirpath)
+                    filenames.sort()
                 dbg("listdired %r", subdirpath)
-                filenames.sort()
 
             except OSError as e:
                 exc("Error %r calling listdir for subdirpath %r, raising if not ENOENT %d vs %d", 
@@ -969,11 +1352,29 @@ class Worker(QObject):
                     #     database which is good, but will abort the program.
                     #     Trap, backoff, and retry instead
                     raise
-                info("ENOENT for listdir, deleting children for subdirpath %r", subdirpath)
+                info("ENOENT for listdir, deleting subtree for subdirpath %r", subdirpath)
+                entries = None
                 filenames = []
 
+                # The whole subtree is gone, delete it with a single prefix
+                # query (which uses the path index) instead of deleting the
+                # children one by one here and then again for each
+                # subdirectory visited by the outer loop.
+                prefix, prefix_end = get_subtree_path_range(subdirpath)
+                conn.execute("DELETE FROM files WHERE (path = ?) OR ((path >= ?) AND (path < ?))",
+                    [subdirpath, prefix, prefix_end])
+                # Skip the rows of this subdirpath and refresh the read cursor so
+                # it continues after the deleted subtree
+                row = None
+                refresh_read_cursor = True
+
             i_filename = 0
-            refresh_read_cursor = False
+            # Collect the changes to this subdirpath and apply them with a
+            # single executemany each instead of one execute per entry. The
+            # read cursor is on a different connection so it doesn't see them
+            # until committed anyway
+            inserted_rows = []
+            deleted_rows = []
             while (True):
 
                 done_with_filenames = (i_filename >= len(filenames))
@@ -994,7 +1395,8 @@ class Worker(QObject):
 
                 else:
                     dbg("comp %r vs %r", filenames[i_filename], row[0])
-                    comp = cmp(filenames[i_filename], row[0])
+                    # Python 3 doesn't have cmp, use the equivalent comparison
+                    comp = (filenames[i_filename] > row[0]) - (filenames[i_filename] < row[0])
 
                 if (comp == 0):
                     # Common case, no update, just increment row and filename Note
@@ -1013,7 +1415,14 @@ class Worker(QObject):
                     # XXX This fails for long paths
                     filepath = os.path.join(subdirpath, filename)
                     dbg("stating %r", filepath)
-                    filestat = os.stat(filepath)
+                    if (filestats is not None):
+                        filestat = filestats[i_filename]
+
+                    elif (entries is not None):
+                        filestat = entries[i_filename].stat()
+
+                    else:
+                        filestat = os.stat(filepath)
                     dbg("stated %r", filepath)
                     is_dir = stat.S_ISDIR(filestat.st_mode)
                     inserted_row = (
@@ -1079,10 +1488,15 @@ class Worker(QObject):
                             0
                         )
                         dbg("Creating dummy entry %r", dummy_row)
-                        conn.execute("INSERT INTO files VALUES (?, ?, ?, ?)", dummy_row)
+                        inserted_rows.append(dummy_row)
                         refresh_read_cursor = True
+
+                        # The outer loop will visit this directory later, start
+                        # listing it now in the background
+                        if (len(self.prefetched_listings) < max_prefetched_listings):
+                            self.prefetched_listings[filepath] = self.listing_pool.apply_async(list_subdir, [filepath])
                         
-                    conn.execute("INSERT INTO files VALUES (?, ?, ?, ?)", inserted_row)
+                    inserted_rows.append(inserted_row)
                     # Commit is done when updating the date the subdirpath being
                     # traversed
                     
@@ -1101,7 +1515,8 @@ class Worker(QObject):
 
                     info("deleted entry %r", row[0])
                     filename = row[0]
-                    conn.execute("DELETE FROM files WHERE name = ? AND path = ?", row[0:2])
+                    deleted_rows.append(row[0:2])
+                    self.dir_mtimes.pop((row[1], row[0]), None)
                     row = read_cursor.fetchone()
                     # Commit is done when updating the date the subdirpath being
                     # traversed
@@ -1109,21 +1524,24 @@ class Worker(QObject):
                     # being skipped and deleted, so there's no risk of skipping
                     # newer items
                     
-                    # XXX This could delete by prefix query which in the case of
-                    #     deleting directories would prevent the children to be
-                    #     hit again and having to be deleted one by one, but the
-                    #     prefix query may require an expensive table scan so
-                    #     it's better to delete them as they are found by the
-                    #     read cursor? Would also need to refresh the read
-                    #     cursor so the deleted prefixed files are not found
-                    #     again
+                    # Note the subtree of a deleted directory is deleted with
+                    # a prefix query when the directory is visited by the
+                    # outer loop, see the listdir ENOENT case above
+
+            # Note deleted and inserted rows never have the same name and path
+            # so the order doesn't matter
+            if (len(deleted_rows) > 0):
+                conn.executemany("DELETE FROM files WHERE name = ? AND path = ?", deleted_rows)
+            if (len(inserted_rows) > 0):
+                conn.executemany("INSERT INTO files(name, path, size, mtime) VALUES (?, ?, ?, ?)", inserted_rows)
 
             # Done with this subdirpath, update the subdirpath date
             # XXX Note this is still called if the subdirpath was deleted,
             #     should be harmless but avoid?
             info("updating time for %r to %d max was %d", subdirpath, subdirpath_mtime, subdirpath_max_mtime)
             conn.execute("UPDATE files SET mtime = ? WHERE ((name = ?) AND (path = ?))",
-                [subdirpath_mtime, os.path.basename(subdirpath), os.path.dirname(subdirpath)])
+                [subdirpath_mtime, subdirpath_key[1], subdirpath_key[0]])
+            self.dir_mtimes[subdirpath_key] = subdirpath_mtime
             
 
             if (refresh_read_cursor):
@@ -1140,7 +1558,7 @@ class Worker(QObject):
                 #     stalls on XP, but that requires more complex logic for the
                 #     read cursor update
                 info("committing changes for %r", subdirpath)
-                conn.commit()
+                self.commit()
                 
                 # Note this query can spill into other dirpaths, the caller has
                 # to handle that and stop
@@ -1152,21 +1570,34 @@ class Worker(QObject):
             # This subdirpath wasn't modified, advance the cursor upto the next 
             # subdirpath
             # Subdirectories will be visited as part of the outer query
-            dbg("subpath %r not modified, skipping by recreating query", subdirpath)
-            # This is a hotpath and skipping by requerying seems to be at least
-            # as fast as skipping manually, use the query
-            # Note this query can spill into other dirpaths, the caller has
-            # to handle that and stop
-            read_cursor.execute("SELECT * FROM files WHERE (path > ?) ORDER BY path ASC, name ASC", [subdirpath])
-            row = read_cursor.fetchone()
+            dbg("subpath %r not modified, skipping", subdirpath)
+            # This is a hotpath. Skipping by requerying seems to be at least as
+            # fast as skipping manually for directories with lots of entries,
+            # but for the common case of a few entries, fetching them is
+            # cheaper than discarding the cursor position and seeking the index
+            # again, so fetch a few and only requery if there are more.
+            # Note the cursor only sees committed changes up to the last
+            # requery, but no changes are committed without requerying, so both
+            # ways of skipping return the same rows
+            for _ in range(max_skipped_rows):
+                if ((row is None) or (row[1] != subdirpath)):
+                    break
+                row = read_cursor.fetchone()
+
+            else:
+                dbg("subpath %r not modified, skipping by recreating query", subdirpath)
+                # Note this query can spill into other dirpaths, the caller has
+                # to handle that and stop
+                read_cursor.execute("SELECT * FROM files WHERE (path > ?) ORDER BY path ASC, name ASC", [subdirpath])
+                row = read_cursor.fetchone()
 
         return row
 
 
     def update_db(self, dirpath):
-        self.started.emit(dirpath)
+        self.message_queue.put(("started", dirpath))
             
-        conn = sqlite3.connect(database_filepath)
+        conn = self.conn
         
         # Make sure dirpath is unicode so os.dirlist, etc return unicode too
         dirpath = unicode(dirpath)
@@ -1205,7 +1636,7 @@ class Worker(QObject):
                 0
             )
 
-            conn.execute("INSERT INTO files VALUES (?, ?, ?, ?)", inserted_row)
+            conn.execute("INSERT INTO files(name, path, size, mtime) VALUES (?, ?, ?, ?)", inserted_row)
             dummy_row = (
                 ".",
                 dirpath,
@@ -1213,9 +1644,9 @@ class Worker(QObject):
                 0
             )
             info("Creating new dirpath %r dummy entry %r", dirpath, dummy_row)
-            conn.execute("INSERT INTO files VALUES (?, ?, ?, ?)", dummy_row)
+            conn.execute("INSERT INTO files(name, path, size, mtime) VALUES (?, ?, ?, ?)", dummy_row)
             
-            conn.commit()
+            self.commit()
         
         # Note that ord("\\") == 92, ord("/") == 47, so this query doesn't guarantee
         # that paths inside the same directory are sorted consecutively, eg one sort
@@ -1225,8 +1656,28 @@ class Worker(QObject):
         #   dir1\dir2a\dir3
         # where the subdirs of dir1: dir2A, dir2 and dir2a are not visited
         # sequentially 
-        read_conn = sqlite3.connect(database_filepath)
-        read_cursor = read_conn.execute("SELECT * FROM files WHERE path >= ? ORDER BY path ASC, name ASC", [dirpath])
+        read_cursor = self.read_conn.execute("SELECT * FROM files WHERE path >= ? ORDER BY path ASC, name ASC", [dirpath])
+
+        # Fetch the mtimes of all the directories under dirpath (and dirpath
+        # itself) with a single query, keyed by (path, name). Directories
+        # inserted during this update are not in the dict, which is the same
+        # as their zero mtime in the database
+        # Note the path needs to be bounded above, otherwise this would also
+        # fetch the directories of any other dirpaths sorted after this one
+        prefix, prefix_end = get_subtree_path_range(dirpath)
+        self.dir_mtimes = dict(
+            ((path, name), mtime) for path, name, mtime in conn.execute(
+                "SELECT path, name, mtime FROM files WHERE (size < 0) AND ("
+                    "((path = ?) AND (name = ?)) OR (path = ?) OR ((path >= ?) AND (path < ?))"
+                ")", 
+                [os.path.dirname(dirpath), os.path.basename(dirpath), dirpath, prefix, prefix_end]
+            )
+        )
+        
+        # Listings of new directories found while traversing, keyed by
+        # subdirpath
+        self.listing_pool = ThreadPool(listing_threads)
+        self.prefetched_listings = {}
 
         row = read_cursor.fetchone()
         while (row is not None):
@@ -1243,6 +1694,13 @@ class Worker(QObject):
             #     database updates
             row = self.update_db_subdir(conn, read_cursor, subdirpath, row)
 
+        # Listings can be left over if the traversal was stopped early, those
+        # directories will be listed again on the next update
+        self.listing_pool.terminate()
+        self.listing_pool.join()
+        self.prefetched_listings = {}
+        self.dir_mtimes = {}
+
         # Commit causes ~0.5s stalls on the sqlite version in Python that
         # supports Windows XP (can be fixed by copying a more recent sqlite
         # dll), so update_db_subdir only commits when there's a new directory
@@ -1250,7 +1708,7 @@ class Worker(QObject):
         # updated). Commit conservatively here in case update_db_subdir left
         # some updates uncommited.
         info("conservatively committing changes for %r", dirpath)
-        conn.commit()
+        self.commit()
         
         read_cursor.close()
 
@@ -1268,25 +1726,129 @@ class Worker(QObject):
                         raise
                 os.rename(csv_filepath, csv_old_filepath)
 
-            with open(csv_filepath, "wb") as f:
+            # Python 2 csv only supports byte strings, Python 3 only text files
+            if (sys.version_info[0] < 3):
+                f = open(csv_filepath, "wb")
+
+            else:
+                f = open(csv_filepath, "w", newline="", encoding="utf-8")
+
+            with f:
                 csv_writer = csv.writer(f, dialect=csv.excel)
-                cursor = conn.execute("SELECT * FROM files ORDER BY path ASC, name ASC;")
+                cursor = conn.execute("SELECT name, path, size, mtime FROM files ORDER BY path ASC, name ASC;")
                 for row in cursor:
-                    row = (row[0].encode('utf-8'), row[1].encode('utf-8'), row[2], row[3])
+                    if (sys.version_info[0] < 3):
+                        row = (row[0].encode('utf-8'), row[1].encode('utf-8'), row[2], row[3])
                     csv_writer.writerow(row)
 
                 cursor.close()
-            
-        conn.close()
-        read_conn.close()
     
-    def run(self):
-        dirpaths = sys.argv[1].split(",")
-        info("Starting worker thread for %r", dirpaths)
+
+def update_dbs(db_filepath, dirpaths, message_queue):
+    """
+    Update the database for each of dirpaths, this is the entry point of the
+    child process started by Worker.
+
+    A ("finished", None) message is sent to message_queue when done, even on
+    errors.
+    """
+    global database_filepath
+    # The global is only set by main(), which doesn't run in the child process
+    # on Windows
+    database_filepath = db_filepath
+    try:
+        db_updater = DbUpdater(message_queue)
         for dirpath in dirpaths:
-            self.update_db(dirpath)
+            db_updater.update_db(dirpath)
+        db_updater.close()
+
+    finally:
+        message_queue.put(("finished", None))
+
+
+def start_update_process(dirpaths):
+    """
+    Start the child process that updates the database for dirpaths, see
+    update_dbs.
+
+    SQLite connections must not be carried across fork() (the unix locks are
+    per process), and forking a multithreaded process can leave the child
+    deadlocked on a lock held by another thread at fork time. Spawn a fresh
+    interpreter where start methods are available (Python 3.4+). Python 2.7
+    always forks on Unix, so this needs to be called before any database
+    connection is opened and before the worker thread is started.
+
+    @return {tuple} (process, message_queue)
+    """
+    info("Starting worker process for %r", dirpaths)
+    if (hasattr(multiprocessing, "get_context")):
+        context = multiprocessing.get_context("spawn")
+
+    else:
+        context = multiprocessing
+    message_queue = context.Queue()
+    process = context.Process(target=update_dbs, 
+        args=(database_filepath, dirpaths, message_queue))
+    # Don't wait for the update to finish if the app is closed, database
+    # changes are transactional and the update will resume on the next run
+    process.daemon = True
+    process.start()
+
+    return process, message_queue
+
+
+class Worker(QObject):
+    """
+    Run the database update in a child process and relay its progress messages
+    as signals.
+
+    The traversal and the database updates used to run in this thread, but the
+    GIL is shared with the UI thread, which caused UI stalls when ingesting
+    remote directories with lots of files. This thread only waits on the
+    message queue, which releases the GIL.
+
+    The process is started by the caller, see start_update_process
+    """
+    traversing = pyqtSignal(str)
+    modified = pyqtSignal()
+    finished = pyqtSignal()
+    started = pyqtSignal(str)
+
+    def __init__(self, process, message_queue):
+        super(Worker, self).__init__()
+        self.process = process
+        self.message_queue = message_queue
+
+    def run(self):
+        process = self.process
+        message_queue = self.message_queue
+        while (True):
+            try:
+                message, arg = message_queue.get(True, 1.0)
+
+            except queue.Empty:
+                # Don't wait forever if the process died without sending the
+                # finished message
+                if (not process.is_alive()):
+                    warn("Worker process ended with exit code %r", process.exitcode)
+                    break
+                continue
+
+            if (message == "started"):
+                self.started.emit(arg)
+
+            elif (message == "traversing"):
+                self.traversing.emit(arg)
+
+            elif (message == "modified"):
+                self.modified.emit()
+
+            else:
+                break
+
+        process.join()
         self.finished.emit()
-        info("Ended worker thread for %r", dirpaths)
+        info("Ended worker process %r", process.pid)
 
 
 def verify_pyqt5_installation():
@@ -1390,6 +1952,163 @@ def verify_sqlite_installation():
             slow_sqlite3_version, sqlite3.sqlite_version_info, slow_sqlite3_version)
 
 
+drop_fts_triggers_script = """
+    DROP TRIGGER IF EXISTS files_fts_insert;
+    DROP TRIGGER IF EXISTS files_fts_delete;
+    DROP TRIGGER IF EXISTS files_fts_update;
+"""
+def create_files_table(conn, migrate = False):
+    """
+    Create the files table and its indices. If migrate is True, the existing
+    files table is replaced with the new one, keeping its rows.
+
+    The id is an INTEGER PRIMARY KEY so it's an alias of the rowid, otherwise
+    VACUUM can renumber the rowids and the full text search index, which
+    references them, would point to the wrong files.
+
+    Everything is done in a single transaction so an interrupted migration
+    leaves the old table untouched.
+    """
+    script = "BEGIN;"
+    if (migrate):
+        # Drop the full text search triggers, they would be moved to the old
+        # table. The caller needs to recreate the index
+        script += drop_fts_triggers_script
+        script += "ALTER TABLE files RENAME TO files_old;"
+    script += """
+        CREATE TABLE files(name TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, mtime EPOCH, id INTEGER PRIMARY KEY, UNIQUE (path, name));
+    """
+    if (migrate):
+        # Keep the rowids as ids, the full text search index is rebuilt
+        # anyway in case it was already out of sync. Drop the old table before
+        # creating the indices below since they have the same names
+        script += """
+            INSERT INTO files(id, name, path, size, mtime) SELECT rowid, name, path, size, mtime FROM files_old;
+            DROP TABLE files_old;
+        """
+    # Create the indices after populating, it's faster
+    script += """
+        CREATE INDEX idx_files_name ON files(name);
+        CREATE INDEX idx_files_size ON files(size);
+        CREATE INDEX idx_files_mtime ON files(mtime);
+        CREATE INDEX idx_files_path_asc_name_asc_size_desc_mtime_desc ON files(path ASC, name ASC, size DESC, mtime DESC);
+        CREATE INDEX idx_files_size_desc_path_asc_name_asc_mtime_desc ON files(size DESC, path ASC, name ASC, mtime DESC);
+        COMMIT;
+    """
+    conn.executescript(script)
+
+def drop_fts_triggers(conn):
+    conn.executescript(drop_fts_triggers_script)
+
+def is_fts_available():
+    """
+    @return {bool} True if this sqlite supports FTS5 and the trigram tokenizer
+            (needs sqlite 3.34.0)
+    """
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE fts_check USING fts5(filepath, content='', tokenize='trigram');")
+
+    except sqlite3.OperationalError as e:
+        warn("Full text search not available, falling back to LIKE filtering: %r", e)
+        return False
+
+    finally:
+        conn.close()
+
+    return True
+
+def create_fts_index(conn):
+    """
+    Create the files_fts trigram index and the triggers that keep it in sync
+    with the files table, then populate it with the existing rows.
+
+    The index is contentless (only stores the trigrams and the files id) and
+    indexes the same path + separator + name string the LIKE filter matches
+    against. Note the files id is an INTEGER PRIMARY KEY, so it's the same as
+    the rowid and is not renumbered by VACUUM, see create_files_table.
+
+    @return {bool} True if the index was created, False if this sqlite doesn't
+            support FTS5 or the trigram tokenizer (needs sqlite 3.34.0)
+    """
+    info("Creating full text search index")
+    filepath_expr = "%%s.path || '%s' || %%s.name" % os.sep
+    new_filepath = filepath_expr % ("new", "new")
+    old_filepath = filepath_expr % ("old", "old")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE files_fts USING fts5(filepath, content='', tokenize='trigram');")
+
+    except sqlite3.OperationalError as e:
+        warn("Unable to create full text search index, falling back to LIKE filtering: %r", e)
+        return False
+
+    # Note a contentless table needs the original values in order to delete
+    # them from the index, the update trigger should never be hit since only
+    # the mtime is updated, but be safe
+    conn.executescript("""
+        CREATE TRIGGER files_fts_insert AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts(rowid, filepath) VALUES (new.id, %(new)s);
+        END;
+        CREATE TRIGGER files_fts_delete AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts(files_fts, rowid, filepath) VALUES ('delete', old.id, %(old)s);
+        END;
+        CREATE TRIGGER files_fts_update AFTER UPDATE OF name, path ON files BEGIN
+            INSERT INTO files_fts(files_fts, rowid, filepath) VALUES ('delete', old.id, %(old)s);
+            INSERT INTO files_fts(rowid, filepath) VALUES (new.id, %(new)s);
+        END;
+    """ % { "new" : new_filepath, "old" : old_filepath })
+
+    # XXX This can take a while on big databases, but it only happens once
+    info("Populating full text search index")
+    conn.execute("INSERT INTO files_fts(rowid, filepath) SELECT id, %s FROM files" %
+        (filepath_expr % ("files", "files")))
+    conn.commit()
+    info("Populated full text search index")
+
+    return True
+
+
+def upgrade_db(conn):
+    """
+    Bring an existing database up to date with the current schema and with the
+    full text search support of this sqlite. Done outside of the database
+    creation so existing databases get the updates too.
+    """
+    # Databases created before the files table had an id use the implicit
+    # rowid, which VACUUM can renumber, recreate the table with an id
+    if ("id" not in [column[1] for column in conn.execute("PRAGMA table_info(files)")]):
+        # XXX This can take a while on big databases, but it only happens once
+        info("Adding id to files table")
+        # This drops the full text search triggers, the index is recreated
+        # below
+        create_files_table(conn, True)
+        info("Added id to files table")
+
+    # Create the full text search index if missing
+    if (is_fts_available()):
+        # The index is out of sync if the triggers are missing (eg the
+        # database was updated by a sqlite without full text search support),
+        # recreate it
+        if (conn.execute("SELECT count(*) FROM sqlite_master WHERE (type = 'trigger') AND (name IN ('files_fts_insert', 'files_fts_delete', 'files_fts_update'))").fetchone()[0] < 3):
+            drop_fts_triggers(conn)
+            conn.execute("DROP TABLE IF EXISTS files_fts;")
+            create_fts_index(conn)
+
+    else:
+        # The triggers would fail to insert into the index on every files
+        # table update, drop them so the database can still be updated. The
+        # index table can't be dropped without full text search support, it
+        # will be recreated when a sqlite with support is used
+        drop_fts_triggers(conn)
+
+    # Drop indices redundant with the (path, name) unique index, every
+    # insert and delete has to update them
+    conn.executescript("""
+        DROP INDEX IF EXISTS idx_files_path;
+        DROP INDEX IF EXISTS idx_files_path_asc_name_asc;
+    """)
+
+
 def report_versions():
     info("Python version: %s", sys.version)
 
@@ -1495,19 +2214,13 @@ def main():
         #     that
         #     See https://stackoverflow.com/questions/51535178/how-to-manually-perform-checkpoint-in-sqlite-android
         conn.execute("PRAGMA journal_mode=WAL;")
-        conn.executescript("""
-            CREATE TABLE files(name TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, mtime EPOCH, PRIMARY KEY (path, name));
-            CREATE INDEX idx_files_path ON files(path);
-            CREATE INDEX idx_files_name ON files(name);
-            CREATE INDEX idx_files_size ON files(size);
-            CREATE INDEX idx_files_mtime ON files(mtime);
-            CREATE INDEX idx_files_path_asc_name_asc ON files(path ASC, name ASC);
-            CREATE INDEX idx_files_path_asc_name_asc_size_desc_mtime_desc ON files(path ASC, name ASC, size DESC, mtime DESC);
-            CREATE INDEX idx_files_size_desc_path_asc_name_asc_mtime_desc ON files(size DESC, path ASC, name ASC, mtime DESC);
-        """)
-        conn.commit()
+        create_files_table(conn)
         conn.close()
-    
+
+    conn = sqlite3.connect(database_filepath)
+    upgrade_db(conn)
+    conn.close()
+
     app = QApplication(sys.argv)
     # Documentation says libraryPaths is only valid be used after a QApplication
     # is created, and will contain the value QT_PLUGIN_PATH was set to and
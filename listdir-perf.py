@@ -177,22 +177,47 @@ get_entries_qt_dirit_sleep elapsed 27.4534029961 17378
 
 
 """
+from __future__ import print_function
 
-import datetime
 import os
-import Queue
 import stat
 import sys
 import time
 import threading
-import thread
+
+try:
+    import Queue as queue
+
+except ImportError:
+    # Python 3
+    import queue
+
+try:
+    unicode
+
+except NameError:
+    # Python 3 strings are already unicode
+    unicode = str
+
+from multiprocessing.pool import ThreadPool
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
+try:
+    from os import scandir
+
+except ImportError:
+    try:
+        # Python 2.7 needs the backport, pip install scandir
+        from scandir import scandir
+
+    except ImportError:
+        scandir = None
+
 def get_entries_qt_info(dirpath, recurse = True):
-    print "get_entries_qt_info", dirpath
+    print("get_entries_qt_info", dirpath)
     entries = []
     d = QDir(dirpath)
     for entry in d.entryInfoList():
@@ -204,13 +229,13 @@ def get_entries_qt_info(dirpath, recurse = True):
                 entries.extend(get_entries_qt_info(entry.filePath()))
 
         else:
-            entries.append((entry.fileName(), dirpath, entry.size(), entry.lastModified()))
+            entries.append((entry.fileName(), dirpath, entry.size(), entry.lastModified().toMSecsSinceEpoch()))
 
     return entries
 
 
 def get_entries_qt_dirit(dirpath, recurse = True):
-    ## print "get_entries_qt_dirit", dirpath
+    ## print("get_entries_qt_dirit", dirpath)
 
     entries = []
     d = QDirIterator(dirpath)
@@ -224,7 +249,7 @@ def get_entries_qt_dirit(dirpath, recurse = True):
                 entries.extend(get_entries_qt_dirit(entry.filePath()))
 
         else:
-            entries.append((entry.fileName(), dirpath, entry.size(), entry.lastModified()))
+            entries.append((entry.fileName(), dirpath, entry.size(), entry.lastModified().toMSecsSinceEpoch()))
         
     return entries
 
@@ -232,7 +257,7 @@ def get_entries_qt_dirit(dirpath, recurse = True):
 last_sleep_time = time.time()
 def get_entries_qt_dirit_sleep(dirpath, recurse = True):
     global last_sleep_time
-    ## print "get_entries_qt_dirit", dirpath
+    ## print("get_entries_qt_dirit", dirpath)
 
     entries = []
     d = QDirIterator(dirpath)
@@ -246,7 +271,7 @@ def get_entries_qt_dirit_sleep(dirpath, recurse = True):
                 entries.extend(get_entries_qt_dirit_sleep(entry.filePath()))
 
         else:
-            entries.append((entry.fileName(), dirpath, entry.size(), entry.lastModified()))
+            entries.append((entry.fileName(), dirpath, entry.size(), entry.lastModified().toMSecsSinceEpoch()))
 
         if (time.time() - last_sleep_time > 0.1):
             QThread.usleep(1)
@@ -256,7 +281,7 @@ def get_entries_qt_dirit_sleep(dirpath, recurse = True):
 
 
 def get_entries_qt_dirit_entries(entries, dirpath, recurse = True):
-    ## print "get_entries_qt_dirit_entries", dirpath
+    ## print("get_entries_qt_dirit_entries", dirpath)
     d = QDirIterator(dirpath)
     while (d.next() != ""):
         if (d.fileName() in [".", ".."]):
@@ -268,12 +293,12 @@ def get_entries_qt_dirit_entries(entries, dirpath, recurse = True):
                 get_entries_qt_dirit_entries(entries, entry.filePath())
 
         else:
-            entries.append((entry.fileName(), dirpath, entry.size(), entry.lastModified()))
+            entries.append((entry.fileName(), dirpath, entry.size(), entry.lastModified().toMSecsSinceEpoch()))
         
     return entries
 
 def get_entries_qt_dirit_recursive(dirpath, recurse = True):
-    print "get_entries_qt_dirit_recursive", dirpath
+    print("get_entries_qt_dirit_recursive", dirpath)
     entries = []
     
     flags = QDirIterator.Subdirectories if recurse else 0
@@ -284,12 +309,71 @@ def get_entries_qt_dirit_recursive(dirpath, recurse = True):
         
         entry = d.fileInfo()
         if (not entry.isDir()):
-            entries.append((entry.fileName(), dirpath, entry.size(), entry.lastModified()))
+            entries.append((entry.fileName(), dirpath, entry.size(), entry.lastModified().toMSecsSinceEpoch()))
         
     return entries
 
+def get_entries_scandir(dirpath, recurse = True):
+    ## print("get_entries_scandir", dirpath)
+    entries = []
+
+    # Walk iteratively with an explicit stack of pending directories instead of
+    # recursing
+    dirpaths = [dirpath]
+    while (len(dirpaths) > 0):
+        dirpath = dirpaths.pop()
+        try:
+            it = scandir(dirpath)
+
+        except OSError as e:
+            # This fails for access errors, too long paths
+            print(e)
+            continue
+
+        for entry in it:
+            try:
+                # Don't recurse links to avoid infinite loops, same as
+                # get_entries_os
+                # Note is_dir doesn't need a stat call on either Windows or
+                # Linux, and on Windows entry.stat() is cached from the
+                # directory listing so there's at most one stat per file
+                if (entry.is_dir(follow_symlinks=False)):
+                    if (recurse):
+                        dirpaths.append(entry.path)
+                else:
+                    s = entry.stat()
+                    entries.append((entry.name, dirpath, s.st_size, int(s.st_mtime * 1000.0)))
+
+            except OSError as e:
+                # This fails for broken links
+                print(e)
+
+    return entries
+
+def get_entries_scandir_pool(dirpath, num_threads):
+    ## print("get_entries_scandir_pool", dirpath)
+    
+    # Collect the files and subdirs of the first level, then walk each subdir
+    # on a pool thread. Subtrees are independent and most of the time is spent
+    # in syscalls which release the GIL
+    entries = get_entries_scandir(dirpath, False)
+    try:
+        subdirpaths = [entry.path for entry in scandir(dirpath) if entry.is_dir(follow_symlinks=False)]
+
+    except OSError as e:
+        print(e)
+        subdirpaths = []
+
+    pool = ThreadPool(num_threads)
+    for subdir_entries in pool.imap_unordered(get_entries_scandir, subdirpaths):
+        entries.extend(subdir_entries)
+    pool.close()
+    pool.join()
+
+    return entries
+
 def get_entries_stat(dirpath, recurse=True, queue = None):
-    print "get_entries_stat", dirpath
+    print("get_entries_stat", dirpath)
     entries = []
     
     for entry in os.listdir(dirpath):
@@ -306,7 +390,10 @@ def get_entries_stat(dirpath, recurse=True, queue = None):
             else:
                 entry_time = s.st_mtime
                 entry_size = s.st_size
-                entries.append((entry, dirpath, entry_size, str(datetime.datetime.fromtimestamp(entry_time))))
+                # Store the raw mtime in milliseconds like filefinder does and
+                # leave formatting to display time, most entries are never
+                # displayed
+                entries.append((entry, dirpath, entry_size, int(entry_time * 1000.0)))
                 
         except OSError as e:
             print(e)
@@ -316,12 +403,12 @@ def get_entries_stat(dirpath, recurse=True, queue = None):
 
         except Exception as e:
             # This fails for files with bad timestamps
-            print entry, e
+            print(entry, e)
 
     return entries
 
 def get_entries_os(dirpath, recurse=True, queue = None):
-    #print "get_entries_os", dirpath
+    #print("get_entries_os", dirpath)
 
     entries = []
     
@@ -341,7 +428,10 @@ def get_entries_os(dirpath, recurse=True, queue = None):
             else:
                 entry_time = os.path.getmtime(entry_filepath)
                 entry_size = os.path.getsize(entry_filepath)
-                entries.append((entry, dirpath, entry_size, str(datetime.datetime.fromtimestamp(entry_time))))
+                # Store the raw mtime in milliseconds like filefinder does and
+                # leave formatting to display time, most entries are never
+                # displayed
+                entries.append((entry, dirpath, entry_size, int(entry_time * 1000.0)))
                 
         except OSError as e:
             print(e)
@@ -351,69 +441,80 @@ def get_entries_os(dirpath, recurse=True, queue = None):
             
         except Exception as e:
             # This fails for files with bad timestamps
-            print entry, e
+            print(entry, e)
 
     return entries
 
 
 dirpath = unicode(sys.argv[1])
-print repr(dirpath)
+print(repr(dirpath))
 
-print "get_entries_os", 
+print("get_entries_os", end=" ")
 t = time.time()
 g_entries = get_entries_os(dirpath)
-print "elapsed", time.time() - t, len(g_entries)
-print "get_entries_qt_dirit", 
+print("elapsed", time.time() - t, len(g_entries))
+print("get_entries_qt_dirit", end=" ")
 t = time.time() 
 g_entries = get_entries_qt_dirit(dirpath)
-print "elapsed", time.time() - t, len(g_entries)
-print "get_entries_qt_dirit_sleep", 
+print("elapsed", time.time() - t, len(g_entries))
+print("get_entries_qt_dirit_sleep", end=" ")
 t = time.time() 
 g_entries = get_entries_qt_dirit_sleep(dirpath)
-print "elapsed", time.time() - t, len(g_entries)
+print("elapsed", time.time() - t, len(g_entries))
+if (scandir is not None):
+    print("get_entries_scandir", end=" ")
+    t = time.time() 
+    g_entries = get_entries_scandir(dirpath)
+    print("elapsed", time.time() - t, len(g_entries))
+    for i in range(5):
+        num_threads = 2 * (i + 1)
+        print("get_entries_scandir_pool_%d" % num_threads, end=" ")
+        t = time.time() 
+        g_entries = get_entries_scandir_pool(dirpath, num_threads)
+        print("elapsed", time.time() - t, len(g_entries))
 
 sys.exit()
-print "get_entries_qt_dirit_entries", 
+print("get_entries_qt_dirit_entries", end=" ")
 t = time.time()
 g_entries = get_entries_qt_dirit_entries([], dirpath)
-print "elapsed", time.time() - t, len(g_entries)
-print "get_entries_qt_dirit_recursive", 
+print("elapsed", time.time() - t, len(g_entries))
+print("get_entries_qt_dirit_recursive", end=" ")
 t = time.time() 
 g_entries = get_entries_qt_dirit_recursive(dirpath)
-print "elapsed", time.time() - t, len(g_entries)
-print "get_entries_qt_info", 
+print("elapsed", time.time() - t, len(g_entries))
+print("get_entries_qt_info", end=" ")
 t = time.time() 
 g_entries = get_entries_qt_info(dirpath)
-print "elapsed", time.time() - t, len(g_entries)
-print "get_entries_stat", 
+print("elapsed", time.time() - t, len(g_entries))
+print("get_entries_stat", end=" ")
 t = time.time() 
 g_entries = get_entries_stat(dirpath)
-print "elapsed", time.time() - t, len(g_entries)
+print("elapsed", time.time() - t, len(g_entries))
 
 def worker(queue):
-    print thread.get_ident(), "starting worker"
+    print(threading.current_thread().ident, "starting worker")
     while True:
         try:
-            print thread.get_ident(), "getting from queue"
+            print(threading.current_thread().ident, "getting from queue")
             dirpath = queue.get()
-            print thread.get_ident(), "got", dirpath
+            print(threading.current_thread().ident, "got", dirpath)
             if (dirpath == ""):
-                print thread.get_ident(), "done"
+                print(threading.current_thread().ident, "done")
                 queue.task_done()
                 break
             g_entries.extend(get_entries_stat(dirpath, True, queue))
-            print thread.get_ident(), "done with", dirpath
+            print(threading.current_thread().ident, "done with", dirpath)
         except Exception as e:
-            print e
+            print(e)
 
         queue.task_done()
-    print thread.get_ident(), "exiting worker"
+    print(threading.current_thread().ident, "exiting worker")
 
-for i in xrange(5):
+for i in range(5):
     g_entries = []
-    dirpath_queue = Queue.Queue()
+    dirpath_queue = queue.Queue()
     num_threads = 2 * (i + 1)
-    print "get_entries_stat_%d" % num_threads, 
+    print("get_entries_stat_%d" % num_threads, end=" ")
     
     for i in range(num_threads):
         t = threading.Thread(target=worker, args=(dirpath_queue,) )
@@ -423,7 +524,7 @@ for i in xrange(5):
     t = time.time() 
     dirpath_queue.put(dirpath)
     dirpath_queue.join()
-    print "elapsed", time.time() - t, len(g_entries)
+    print("elapsed", time.time() - t, len(g_entries))
 
     for i in range(num_threads):
         dirpath_queue.put("")